@@ -1,152 +1,228 @@
-from flask import Flask, request, render_template
+from quart import Quart, Response, request, render_template, stream_template
 import os
+import re
+import json
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from functools import lru_cache
 import google.generativeai as genai
-from azure.identity import DefaultAzureCredential
-from azure.mgmt.resource import ResourceManagementClient
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import DefaultAzureCredential
+from azure.mgmt.resource.aio import ResourceManagementClient
+from azure.mgmt.storage.aio import StorageManagementClient
+from azure.mgmt.web.aio import WebSiteManagementClient
 from dotenv import load_dotenv, find_dotenv
 
-# Load environment variables
-env_path = find_dotenv()
-print("Loading env from", env_path)
-load_dotenv(env_path)
-
-app = Flask(__name__)
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables once; reloader children and forked workers inherit them
+if not os.environ.get("_ENV_LOADED"):
+    env_path = find_dotenv()
+    logger.info("Loading env from %s", env_path)
+    load_dotenv(env_path)
+    os.environ["_ENV_LOADED"] = "1"
+
+app = Quart(__name__)
+
+# Tokens are reused until they are this close (in seconds) to expiring
+TOKEN_REFRESH_MARGIN = 60
+
+class CachedCredential:
+    """Reuse bearer tokens across clients; some DefaultAzureCredential
+    sources (e.g. the Azure CLI) spawn a subprocess on every get_token."""
+
+    def __init__(self, inner):
+        self._inner = inner
+        self._tokens = {}
+        self._lock = asyncio.Lock()
+
+    def _cached(self, scopes):
+        token = self._tokens.get(scopes)
+        if token and token.expires_on - time.time() > TOKEN_REFRESH_MARGIN:
+            return token
+        return None
+
+    async def get_token(self, *scopes, **kwargs):
+        # A claims challenge or another tenant means the cached token is the wrong one
+        if kwargs.get("claims") or kwargs.get("tenant_id"):
+            return await self._inner.get_token(*scopes, **kwargs)
+
+        token = self._cached(scopes)
+        if token:
+            return token
+        # Concurrent misses wait for a single refresh instead of each hitting the chain
+        async with self._lock:
+            token = self._cached(scopes)
+            if token:
+                return token
+            token = await self._inner.get_token(*scopes, **kwargs)
+            self._tokens[scopes] = token
+            return token
+
+    async def close(self):
+        await self._inner.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
 
 # Load credentials securely
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 model = genai.GenerativeModel(model_name="models/gemini-1.5-flash")
 subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-credential = DefaultAzureCredential()
-resource_client = ResourceManagementClient(credential, subscription_id)
+credential = CachedCredential(DefaultAzureCredential())
+
+# Seconds between LRO status checks (azure-core defaults to 30)
+POLLING_INTERVAL = 5
+
+# One aiohttp transport shared by every Azure client so connections are reused
+transport = AioHttpTransport()
+
+# Management clients are built once per subscription and reused across requests
+@lru_cache(maxsize=None)
+def get_resource_client(sub_id):
+    return ResourceManagementClient(credential, sub_id, transport=transport)
+
+@lru_cache(maxsize=None)
+def get_storage_client(sub_id):
+    return StorageManagementClient(credential, sub_id, transport=transport)
+
+@lru_cache(maxsize=None)
+def get_web_client(sub_id):
+    return WebSiteManagementClient(credential, sub_id, transport=transport)
+
+@app.after_serving
+async def close_clients():
+    # Clients are cached for the process lifetime; release pooled sockets on shutdown
+    await transport.close()
+    await credential.close()
+
+resource_client = get_resource_client(subscription_id)
+
+# All created resources live in one shared resource group, created on first use.
+# Its location is fixed (ARM won't move an existing group), resources themselves
+# still go to the region the user asked for.
+SHARED_RG = os.getenv("AZURE_SHARED_RG", "app-shared-rg")
+SHARED_RG_LOCATION = os.getenv("AZURE_SHARED_RG_LOCATION", "eastus")
+shared_rg_ready = False
+shared_rg_lock = asyncio.Lock()
+
+async def ensure_shared_resource_group():
+    global shared_rg_ready
+    if not shared_rg_ready:
+        async with shared_rg_lock:
+            if not shared_rg_ready:
+                if not await resource_client.resource_groups.check_existence(SHARED_RG):
+                    await resource_client.resource_groups.create_or_update(SHARED_RG, {"location": SHARED_RG_LOCATION})
+                shared_rg_ready = True
+    return SHARED_RG
 
 # Azure resource creation functions
-def create_resource_group(name, location):
-    resource_client.resource_groups.create_or_update(name, {"location": location})
-    return f"✅ Resource group '{name}' created in '{location}'."
-
-def create_resource_group_resource_type(name, location):
-    resource_client.resource_groups.create_or_update(name, {"location": location})
-    return name
-
-def create_storage_account(name, location):
-    from azure.mgmt.storage import StorageManagementClient
-    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-    credential = DefaultAzureCredential()
-    storage_client = StorageManagementClient(credential, subscription_id)
-    availability = storage_client.storage_accounts.check_name_availability({"name": name})
-    if not availability.name_available:
-        return f"❌ Storage account name '{name}' is not available."
-    rg_name = create_resource_group_resource_type(name, location)
-    print(rg_name)
-    poller = storage_client.storage_accounts.begin_create(
-        resource_group_name=rg_name,
+async def provision_storage_account(storage_client, resource_group_name, name, location):
+    poller = await storage_client.storage_accounts.begin_create(
+        resource_group_name=resource_group_name,
         account_name=name,
         parameters={
             "location": location,
             "kind": "StorageV2",
             "sku": {"name": "Standard_LRS"}
-        }
+        },
+        polling_interval=POLLING_INTERVAL
     )
-    poller.result()
-    return f"✅ Storage account '{name}' created in '{location}'."
+    await poller.result()  # Wait until storage is created
 
-def create_logic_app(name, location):
-    from azure.identity import DefaultAzureCredential
-    from azure.mgmt.resource import ResourceManagementClient
-    import json
-
-    # Credentials and subscription
-    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-    credential = DefaultAzureCredential()
-    resource_client = ResourceManagementClient(credential, subscription_id)
-
-    # Use the same name for resource group
-    resource_group_name = name
-
-    # Create resource group
-    resource_client.resource_groups.create_or_update(resource_group_name, {"location": location})
-
-    # Minimal Logic App template with placeholder logic
-    logicapp_template = {
-        "$schema": "https://schema.management.azure.com/schemas/2019-04-01/deploymentTemplate.json#",
-        "contentVersion": "1.0.0.0",
-        "resources": [
-            {
-                "type": "Microsoft.Logic/workflows",
-                "apiVersion": "2019-05-01",
-                "name": name,
-                "location": location,
-                "properties": {
-                    "definition": {
-                        "$schema": "https://schema.management.azure.com/providers/Microsoft.Logic/schemas/2016-06-01/workflowdefinition.json#",
-                        "contentVersion": "1.0.0.0",
-                        "actions": {},
-                        "outputs": {},
-                        "triggers": {
-                            "When_a_HTTP_request_is_received": {
-                "type": "Request",
-                "kind": "Http",
-                "inputs": {
-                    "schema": {}
-                }
-            }
-                        }
-                    },
-                    "parameters": {}
-                }
-            }
-        ]
-    }
+async def create_resource_group(name, location):
+    await resource_client.resource_groups.create_or_update(name, {"location": location})
+    return f"✅ Resource group '{name}' created in '{location}'."
 
-    # Deployment properties
-    properties = {
+async def create_storage_account(name, location):
+    storage_client = get_storage_client(subscription_id)
+    availability = await storage_client.storage_accounts.check_name_availability({"name": name})
+    if not availability.name_available:
+        return f"❌ Storage account name '{name}' is not available."
+    rg_name = await ensure_shared_resource_group()
+    await provision_storage_account(storage_client, rg_name, name, location)
+    return f"✅ Storage account '{name}' created in '{location}'."
+
+# Minimal Logic App deployment with placeholder logic, serialized once;
+# only the name and location change per request
+LOGICAPP_DEPLOYMENT_JSON = json.dumps({
+    "properties": {
         "mode": "Incremental",
-        "template": logicapp_template,
+        "template": {
+            "$schema": "https://schema.management.azure.com/schemas/2019-04-01/deploymentTemplate.json#",
+            "contentVersion": "1.0.0.0",
+            "resources": [
+                {
+                    "type": "Microsoft.Logic/workflows",
+                    "apiVersion": "2019-05-01",
+                    "name": "__NAME__",
+                    "location": "__LOC__",
+                    "properties": {
+                        "definition": {
+                            "$schema": "https://schema.management.azure.com/providers/Microsoft.Logic/schemas/2016-06-01/workflowdefinition.json#",
+                            "contentVersion": "1.0.0.0",
+                            "actions": {},
+                            "outputs": {},
+                            "triggers": {
+                                "When_a_HTTP_request_is_received": {
+                                    "type": "Request",
+                                    "kind": "Http",
+                                    "inputs": {
+                                        "schema": {}
+                                    }
+                                }
+                            }
+                        },
+                        "parameters": {}
+                    }
+                }
+            ]
+        },
         "parameters": {}
     }
+})
+
+async def create_logic_app(name, location):
+    resource_group_name = await ensure_shared_resource_group()
+
+    # json.dumps keeps the substituted values valid JSON strings
+    deployment = json.loads(
+        LOGICAPP_DEPLOYMENT_JSON
+        .replace('"__NAME__"', json.dumps(name))
+        .replace('"__LOC__"', json.dumps(location))
+    )
 
     # Begin deployment using poller
     try:
-        poller = resource_client.deployments.begin_create_or_update(
+        poller = await resource_client.deployments.begin_create_or_update(
             resource_group_name,
             f"{name}-logicapp-deployment",
-            {
-            "properties": {
-            "mode": "Incremental",
-            "template": logicapp_template,
-            "parameters": {}
-             }
-            }
+            deployment,
+            polling_interval=POLLING_INTERVAL
         )
-        result = poller.result()
+        result = await poller.result()
         return f"✅ Logic App '{name}' successfully deployed in '{location}'."
     except Exception as e:
         return f"❌ Failed to deploy Logic App: {e}"
 
-def create_web_app(name, location):
-    from azure.mgmt.web import WebSiteManagementClient
-    from azure.mgmt.resource import ResourceManagementClient
-    from azure.identity import DefaultAzureCredential
-    import os
-
-    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-    credential = DefaultAzureCredential()
-
+async def create_web_app(name, location):
     # Clients
-    web_client = WebSiteManagementClient(credential, subscription_id)
-    resource_client = ResourceManagementClient(credential, subscription_id)
+    web_client = get_web_client(subscription_id)
 
-    resource_group_name = name
+    resource_group_name = await ensure_shared_resource_group()
     app_service_plan_name = f"{name}-plan"
     web_app_name = f"{name}-web"
 
-    # Step 1: Create or update Resource Group
-    resource_client.resource_groups.create_or_update(resource_group_name, {"location": location})
-
-    # Step 2: Create App Service Plan
+    # Step 1: Create App Service Plan
     try:
-        print("⏳ Creating App Service Plan...")
-        poller = web_client.app_service_plans.begin_create_or_update(
+        logger.debug("Creating App Service Plan %s", app_service_plan_name)
+        poller = await web_client.app_service_plans.begin_create_or_update(
             resource_group_name=resource_group_name,
             name=app_service_plan_name,
             app_service_plan={
@@ -156,62 +232,56 @@ def create_web_app(name, location):
                     "tier": "Basic",
                     "capacity": 1
                 }
-            }
+            },
+            polling_interval=POLLING_INTERVAL
         )
-        poller.result()
+        await poller.result()
     except Exception as e:
         return f"❌ Failed to create App Service Plan: {e}"
 
-    # Step 3: Create Web App
+    # Step 2: Create Web App
     try:
-        print("⏳ Creating Web App...")
-        poller = web_client.web_apps.begin_create_or_update(
+        logger.debug("Creating Web App %s", web_app_name)
+        poller = await web_client.web_apps.begin_create_or_update(
             resource_group_name=resource_group_name,
             name=web_app_name,
             site_envelope={
                 "location": location,
                 "server_farm_id": f"/subscriptions/{subscription_id}/resourceGroups/{resource_group_name}/providers/Microsoft.Web/serverfarms/{app_service_plan_name}"
-            }
+            },
+            polling_interval=POLLING_INTERVAL
         )
-        poller.result()
+        await poller.result()
         return f"✅ Web App '{web_app_name}' successfully created in '{location}'."
     except Exception as e:
         return f"❌ Failed to create Web App: {e}"
 
 
-def create_function_app(name, location):
-    from azure.mgmt.web import WebSiteManagementClient
-    from azure.mgmt.storage import StorageManagementClient
-    subscription_id = os.getenv("AZURE_SUBSCRIPTION_ID")
-    credential = DefaultAzureCredential()
-
+async def create_function_app(name, location):
     # Initialize clients
-    web_client = WebSiteManagementClient(credential, subscription_id)
-    storage_client = StorageManagementClient(credential, subscription_id)
+    web_client = get_web_client(subscription_id)
+    storage_client = get_storage_client(subscription_id)
 
-    # Step 1: Create Storage Account (required for Function App)
+    # Storage account names are global; bail out before creating anything if taken
     try:
-        availability = storage_client.storage_accounts.check_name_availability({"name": name})
-        if not availability.name_available:
-            print("⏳ Creating storage account...")
-            poller = storage_client.storage_accounts.begin_create(
-                resource_group_name=name,
-                account_name=name,
-                parameters={
-                    "location": location,
-                    "kind": "StorageV2",
-                    "sku": {"name": "Standard_LRS"}
-                }
-            )
-            poller.result()  # Wait until storage is created
+        availability = await storage_client.storage_accounts.check_name_availability({"name": name})
     except Exception as e:
         return f"❌ Failed to create storage: {e}"
+    if not availability.name_available:
+        return f"❌ Storage account name '{name}' is not available."
+
+    resource_group_name = await ensure_shared_resource_group()
+
+    # Step 1: Create Storage Account (required for Function App)
+    async def create_storage():
+        logger.debug("Creating storage account %s", name)
+        await provision_storage_account(storage_client, resource_group_name, name, location)
 
     # Step 2: Create App Service Plan (consumption plan)
-    try:
-        print("⏳ Creating app service plan...")
-        poller = web_client.app_service_plans.begin_create_or_update(
-            resource_group_name=name,
+    async def create_plan():
+        logger.debug("Creating app service plan %s-plan", name)
+        poller = await web_client.app_service_plans.begin_create_or_update(
+            resource_group_name=resource_group_name,
             name=f"{name}-plan",
             app_service_plan={
                 "location": location,
@@ -221,21 +291,34 @@ def create_function_app(name, location):
                         },
                         "kind": "functionapp",
                         "reserved": False
-            }
+            },
+            polling_interval=POLLING_INTERVAL
         )
-        poller.result()
-    except Exception as e:
-        return f"❌ Failed to create app service plan: {e}"
+        await poller.result()
+
+    # Storage and plan don't depend on each other, so wait for both together.
+    # The site must wait for both: web_apps rejects a server_farm_id that doesn't
+    # exist yet, and creating it before storage succeeds would leave a Function App
+    # pointing at a missing account if storage then fails.
+    storage_error, plan_error = await asyncio.gather(
+        create_storage(), create_plan(), return_exceptions=True
+    )
+
+    if storage_error:
+        return f"❌ Failed to create storage: {storage_error}"
+
+    if plan_error:
+        return f"❌ Failed to create app service plan: {plan_error}"
 
     # Step 3: Create Function App
     try:
-        print("⏳ Creating Function App...")
-        poller = web_client.web_apps.begin_create_or_update(
-            resource_group_name=name,
+        logger.debug("Creating Function App %s-func", name)
+        poller = await web_client.web_apps.begin_create_or_update(
+            resource_group_name=resource_group_name,
             name=f"{name}-func",
             site_envelope={
                 "location": location,
-                "server_farm_id": f"/subscriptions/{subscription_id}/resourceGroups/{name}/providers/Microsoft.Web/serverfarms/{name}-plan",
+                "server_farm_id": f"/subscriptions/{subscription_id}/resourceGroups/{resource_group_name}/providers/Microsoft.Web/serverfarms/{name}-plan",
                 "kind": "functionapp",
                 "site_config": {
                     "app_settings": [
@@ -244,9 +327,10 @@ def create_function_app(name, location):
                         {"name": "FUNCTIONS_WORKER_RUNTIME", "value": "python"}
                     ]
                 }
-            }
+            },
+            polling_interval=POLLING_INTERVAL
         )
-        poller.result()
+        await poller.result()
         return f"✅ Function App '{name}-func' successfully created in '{location}'."
     except Exception as e:
         return f"❌ Failed to create Function App: {e}"
@@ -254,14 +338,26 @@ def create_function_app(name, location):
 
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    result = ""
-    if request.method == "POST":
-        user_prompt = request.form.get("message")
+# Resource type keyword -> (creation function, allowed name), checked in order.
+# Name rules mirror ARM's so bad Gemini output is caught without a round-trip.
+DISPATCH = {
+    # 1-90 chars of letters, digits, -_.(), not ending in a period
+    "resource group": (create_resource_group, re.compile(r"[-\w.()]{0,89}[-\w()]")),
+    # Globally unique, 3-24 lowercase letters and digits
+    "storage account": (create_storage_account, re.compile(r"[a-z0-9]{3,24}")),
+    # Name is reused for the storage account, so the storage rule applies
+    "function app": (create_function_app, re.compile(r"[a-z0-9]{3,24}")),
+    # Site name is "<name>-web", at most 60 letters, digits and hyphens
+    "web app": (create_web_app, re.compile(r"[a-z0-9][a-z0-9-]{0,55}")),
+    # Deployment name is "<name>-logicapp-deployment", at most 64 chars
+    "logic app": (create_logic_app, re.compile(r"[-\w.()]{1,45}")),
+}
 
-        # Gemini system prompt
-        system_prompt = """
+def lookup_handler(resource_type):
+    return next((entry for key, entry in DISPATCH.items() if key in resource_type), None)
+
+# Gemini system prompt
+SYSTEM_PROMPT = """
 You are an Azure cloud assistant.
 Your job is to extract deployment information from user commands related to Azure resource creation.
 
@@ -287,34 +383,92 @@ Rules:
 - If unclear, default to "resource group"
 """
 
-        try:
-            full_prompt = system_prompt + f"\n\nCommand:\n\"{user_prompt}\""
-            response = model.generate_content(full_prompt)
-            parsed = response.text.strip().lower()
-
-            resource_type = parsed.split("resource_type:")[1].split("name:")[0].strip()
-            name = parsed.split("name:")[1].split("location:")[0].strip()
-            location = parsed.split("location:")[1].strip()
-
-            if "resource group" in resource_type:
-                result = create_resource_group(name, location)
-            elif "storage account" in resource_type:
-                result = create_storage_account(name, location)
-            elif "function app" in resource_type:
-                result = create_function_app(name, location)
-            elif "web app" in resource_type:
-                result = create_web_app(name, location)
-            elif "logic app" in resource_type:
-                result = create_logic_app(name, location)
-            elif "Web app" in resource_type:
-                result = create_web_app(name, location)
-            else:
-                result = f"❌ Unknown resource type '{resource_type}'."
-
-        except Exception as e:
-            result = f"❌ Error: {e}"
-
-    return render_template("index.html", result=result)
+# Single-pass extraction of the three fields from Gemini's reply
+PARSE_RE = re.compile(
+    r"resource_type:\s*(?P<rt>.+?)\s*name:\s*(?P<n>.+?)\s*location:\s*(?P<loc>.+)",
+    re.DOTALL
+)
+
+# Cheap local checks so malformed Gemini output never reaches ARM
+LOC_RE = re.compile(r"[a-z0-9]+")
+
+# Repeated commands (retries, demos) reuse the earlier Gemini answer
+PARSE_CACHE_SIZE = 1024
+parse_cache = OrderedDict()
+
+async def parse_command(user_prompt):
+    if user_prompt in parse_cache:
+        parse_cache.move_to_end(user_prompt)
+        return parse_cache[user_prompt]
+
+    full_prompt = SYSTEM_PROMPT + f"\n\nCommand:\n\"{user_prompt}\""
+    response = await model.generate_content_async(full_prompt)
+    # Read the first part directly rather than through the response.text accessor
+    if not response.candidates or not response.candidates[0].content.parts:
+        feedback = getattr(response, "prompt_feedback", None)
+        raise ValueError(f"Gemini returned no content (prompt feedback: {feedback})")
+    raw = response.candidates[0].content.parts[0].text
+    parsed = raw.strip().lower()
+
+    m = PARSE_RE.search(parsed)
+    if m is None:
+        raise ValueError(f"Could not parse Gemini response: {parsed!r}")
+    resource_type = m.group("rt").strip()
+    name = m.group("n").strip()
+    location = m.group("loc").strip().replace(" ", "")  # "west europe" -> "westeurope"
+
+    # Validate before caching so a retry of the same command asks Gemini again;
+    # unknown types are left for deploy() to report
+    entry = lookup_handler(resource_type)
+    if entry:
+        _, name_re = entry
+        if not name_re.fullmatch(name):
+            raise ValueError(f"Invalid {resource_type} name '{name}'.")
+        if not LOC_RE.fullmatch(location):
+            raise ValueError(f"Invalid location '{location}'.")
+    fields = resource_type, name, location
+
+    parse_cache[user_prompt] = fields
+    if len(parse_cache) > PARSE_CACHE_SIZE:
+        parse_cache.popitem(last=False)
+    return fields
+
+
+async def deploy(user_prompt):
+    try:
+        resource_type, name, location = await parse_command(user_prompt.strip().lower())
+
+        entry = lookup_handler(resource_type)
+        if entry:
+            handler, _ = entry
+            result = await handler(name, location)
+        else:
+            result = f"❌ Unknown resource type '{resource_type}'."
+
+    except Exception as e:
+        result = f"❌ Error: {e}"
+
+    yield result
+
+
+@app.route("/", methods=["GET", "POST"])
+async def index():
+    if request.method == "POST":
+        form = await request.form
+        user_prompt = form.get("message")
+
+        # Stream the page so the browser renders it while Azure is still working
+        response = Response(
+            await stream_template("index.html", result=deploy(user_prompt)),
+            mimetype="text/html"
+        )
+        # The deployment runs inside the streamed body, and web/function app LROs
+        # routinely exceed Quart's 60 s RESPONSE_TIMEOUT, which would silently cut
+        # the body off mid-deploy; let the stream run until the deploy finishes
+        response.timeout = None
+        return response
+
+    return await render_template("index.html", result="")
 
 if __name__ == "__main__":
     app.run(debug=True)